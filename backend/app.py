@@ -1,25 +1,142 @@
+import asyncio
+import logging
 import os
+import sys
+from contextlib import AsyncExitStack
 from datetime import datetime, timedelta, timezone
-from typing import List
-from fastapi import FastAPI
+from typing import List, Tuple
+import httpx
+import msgspec
+import numpy as np
+import redis
+from aiocache import Cache, RedisCache, cached_stampede
+from aiocache.lock import RedLock
+from aiocache.serializers import BaseSerializer
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
+from redis.connection import SSLConnection, parse_url as parse_redis_url
 
-from graph_client import GraphClient
+from graph_client import (
+    CLOSED_STATUSES, GraphClient,
+    HEALTH_OVERVIEWS_QUERY, HEALTH_ISSUES_QUERY, SUBSCRIBED_SKUS_QUERY, ORGANIZATION_QUERY
+)
 from models import (
     HealthIssue, HealthOverview, HealthResponse,
     LicenseSku, LicenseResponse,
     SignInBucket, SignInSummary,
-    TenantInfo, TenantResponse
+    TenantInfo, TenantResponse,
+    DashboardResponse
 )
 
 load_dotenv()
+logger = logging.getLogger("m365monitor")
 TENANT_ID = os.getenv("TENANT_ID", "")
 CLIENT_ID = os.getenv("CLIENT_ID", "")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET", "")
+REDIS_URL = os.getenv("REDIS_URL", "")
 ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "*").split(",")]
 
-app = FastAPI(title="M365‑Monitor API")
+# Cache-Laufzeiten (Sekunden) – Graph-Daten ändern sich nur im Minuten-/Stundenbereich
+CACHE_TTL_HEALTH = int(os.getenv("CACHE_TTL_HEALTH", "60"))
+CACHE_TTL_SIGNINS = int(os.getenv("CACHE_TTL_SIGNINS", "60"))
+CACHE_TTL_LICENSES = int(os.getenv("CACHE_TTL_LICENSES", "600"))
+CACHE_TTL_TENANT = int(os.getenv("CACHE_TTL_TENANT", "3600"))
+# Lock-Dauer beim Nachladen, damit nach Ablauf nur ein Request Graph abfragt
+CACHE_LEASE = 30
+
+class StructSerializer(BaseSerializer):
+    # msgpack über msgspec statt pickle: Redis-Inhalte werden nur als Daten dekodiert, nie ausgeführt
+    DEFAULT_ENCODING = None
+
+    def __init__(self, value_type, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._decoder = msgspec.msgpack.Decoder(value_type)
+
+    def dumps(self, value) -> bytes:
+        return msgspec.msgpack.encode(value)
+
+    def loads(self, value):
+        if value is None:
+            return None
+        return self._decoder.decode(value)
+
+_CACHE_ERRORS = (redis.RedisError, OSError, asyncio.TimeoutError)
+
+class FallbackRedisCache(RedisCache):
+    # Redis-Ausfall darf keine Requests scheitern lassen: Lesefehler gelten als Miss,
+    # Schreibfehler werden ignoriert, der Stampede-Lock gilt dann als erhalten bzw. freigegeben.
+    async def get(self, *args, **kwargs):
+        try:
+            return await super().get(*args, **kwargs)
+        except _CACHE_ERRORS as e:
+            logger.warning("Redis get failed, treating as cache miss: %s", e)
+            return None
+
+    async def set(self, *args, **kwargs):
+        try:
+            return await super().set(*args, **kwargs)
+        except _CACHE_ERRORS as e:
+            logger.warning("Redis set failed, value not cached: %s", e)
+            return False
+
+    async def _add(self, *args, **kwargs):
+        try:
+            return await super()._add(*args, **kwargs)
+        except _CACHE_ERRORS as e:
+            logger.warning("Redis lock unavailable, loading without lock: %s", e)
+            return True
+
+    async def _redlock_release(self, *args, **kwargs):
+        try:
+            return await super()._redlock_release(*args, **kwargs)
+        except _CACHE_ERRORS:
+            # lokal wartende Requests trotzdem freigeben
+            return 1
+
+# mit REDIS_URL liegt der Cache in Redis und gilt für alle Worker, sonst pro Prozess im Speicher.
+# Die Stampede-Locks wirken nur innerhalb eines Workers. Die URL wird wie beim Token-Cache
+# von redis-py geparst (Benutzer, Passwort, rediss://); Unix-Sockets werden nicht unterstützt.
+if REDIS_URL:
+    _redis = parse_redis_url(REDIS_URL)
+    _REDIS_CACHE = dict(
+        cache=FallbackRedisCache,
+        endpoint=_redis.get("host", "127.0.0.1"),
+        port=_redis.get("port", 6379),
+        db=_redis.get("db", 0),
+        password=_redis.get("password"),
+        ssl=_redis.get("connection_class") is SSLConnection,
+        connection_pool_kwargs={"username": _redis["username"]} if _redis.get("username") else None,
+        namespace="m365monitor",
+    )
+
+def cache_config(value_type) -> dict:
+    if not REDIS_URL:
+        return dict(cache=Cache.MEMORY)
+    return dict(_REDIS_CACHE, serializer=StructSerializer(value_type))
+
+def _route_key(f, *args, **kwargs):
+    return f.__name__
+
+def _clamp_hours(hours: int) -> int:
+    return max(1, min(hours, 168))  # 1..168h
+
+def _signins_key(f, hours: int = 24):
+    # geklemmter Wert, damit z. B. hours=168 und hours=500 denselben Eintrag teilen
+    return f"{f.__name__}:{_clamp_hours(hours)}"
+
+_json_encoder = msgspec.json.Encoder()
+
+class MsgspecResponse(Response):
+    # Structs direkt nach JSON kodieren, ohne jsonable_encoder/pydantic-Umweg
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return _json_encoder.encode(content)
+
+app = FastAPI(title="M365‑Monitor API", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS if ALLOWED_ORIGINS != ["*"] else ["*"],
@@ -27,24 +144,28 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+graph = GraphClient(TENANT_ID, CLIENT_ID, CLIENT_SECRET, REDIS_URL)
 
-graph = GraphClient(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+@app.on_event("shutdown")
+async def shutdown():
+    await graph.aclose()
 
 @app.get("/api/ping")
 def ping():
-    return {"ok": True, "time": datetime.now(timezone.utc).isoformat()}
-
-@app.get("/api/health", response_model=HealthResponse)
-async def health():
-    over = await graph.get_health_overviews()
-    issues = await graph.get_health_issues()
+    return ORJSONResponse({"ok": True, "time": datetime.now(timezone.utc).isoformat()})
 
+def build_health(over: List[dict], issues: List[dict]) -> HealthResponse:
     services: List[HealthOverview] = []
     for s in over:
         services.append(HealthOverview(service=s.get("service", "unknown"), status=s.get("status", "unknown")))
 
+    # zusätzlich zum $filter: erledigte Issues vor dem Aufbau der Structs verwerfen
     open_issues: List[HealthIssue] = []
     for i in issues:
+        if (i.get("status") or "").lower() in CLOSED_STATUSES:
+            continue
         open_issues.append(HealthIssue(
             id=i.get("id", ""),
             service=i.get("service", None),
@@ -56,14 +177,14 @@ async def health():
             lastModifiedDateTime=i.get("lastModifiedDateTime", None),
         ))
 
-    # nur offene/vor kurzem geänderte Issues oben halten
-    open_issues = [x for x in open_issues if (x.status or "").lower() != "servicerestored"]
-
     return HealthResponse(services=services, openIssues=open_issues)
 
-@app.get("/api/licenses", response_model=LicenseResponse)
-async def licenses():
-    skus_raw = await graph.get_subscribed_skus()
+@cached_stampede(lease=CACHE_LEASE, ttl=CACHE_TTL_HEALTH, key_builder=_route_key, **cache_config(HealthResponse))
+async def load_health() -> HealthResponse:
+    over, issues = await asyncio.gather(graph.get_health_overviews(), graph.get_health_issues())
+    return build_health(over, issues)
+
+def build_licenses(skus_raw: List[dict]) -> LicenseResponse:
     skus: List[LicenseSku] = []
     for s in skus_raw:
         enabled = s.get("prepaidUnits", {}).get("enabled", 0)
@@ -80,9 +201,11 @@ async def licenses():
         ))
     return LicenseResponse(skus=skus)
 
-@app.get("/api/tenant", response_model=TenantResponse)
-async def tenant():
-    t = await graph.get_tenant()
+@cached_stampede(lease=CACHE_LEASE, ttl=CACHE_TTL_LICENSES, key_builder=_route_key, **cache_config(LicenseResponse))
+async def load_licenses() -> LicenseResponse:
+    return build_licenses(await graph.get_subscribed_skus())
+
+def build_tenant(t: dict) -> TenantResponse:
     domains = [d.get("name") for d in t.get("verifiedDomains", []) if d.get("name")]
     return TenantResponse(tenant=TenantInfo(
         id=t.get("id", ""),
@@ -90,40 +213,118 @@ async def tenant():
         verifiedDomains=domains,
     ))
 
-@app.get("/api/signins", response_model=SignInSummary)
-async def signins(hours: int = 24):
-    hours = max(1, min(hours, 168))  # 1..168h
-    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+@cached_stampede(lease=CACHE_LEASE, ttl=CACHE_TTL_TENANT, key_builder=_route_key, **cache_config(TenantResponse))
+async def load_tenant() -> TenantResponse:
+    return build_tenant(await graph.get_tenant())
+
+_OVERVIEW_LOADERS = (load_health, load_licenses, load_tenant)
+
+async def _cached_overview_parts() -> list:
+    return await asyncio.gather(*(loader.cache.get(_route_key(loader)) for loader in _OVERVIEW_LOADERS))
+
+async def load_overview() -> Tuple[HealthResponse, LicenseResponse, TenantResponse]:
+    # vorhandene Einträge der Einzel-Caches nutzen, nur fehlende Teile per $batch nachladen
+    parts = await _cached_overview_parts()
+    if None not in parts:
+        return tuple(parts)
+    async with AsyncExitStack() as locks:
+        # dieselben Stampede-Locks wie die Einzel-Loader: parallele Dashboards und
+        # /api/health & Co. warten auf den laufenden Abruf statt selbst Graph zu fragen
+        for loader, value in zip(_OVERVIEW_LOADERS, parts):
+            if value is None:
+                await locks.enter_async_context(RedLock(loader.cache, _route_key(loader), CACHE_LEASE))
+        h, l, t = await _cached_overview_parts()
+        queries = {}
+        if h is None:
+            queries["overviews"] = HEALTH_OVERVIEWS_QUERY
+            queries["issues"] = HEALTH_ISSUES_QUERY
+        if l is None:
+            queries["skus"] = SUBSCRIBED_SKUS_QUERY
+        if t is None:
+            queries["organization"] = ORGANIZATION_QUERY
+        if not queries:
+            return h, l, t
+        try:
+            values = await graph.get_batch(queries)
+        except (httpx.HTTPError, RuntimeError):
+            values = None
+
+        if values is not None:
+            # Ergebnisse mit der jeweiligen TTL in die Einzel-Caches schreiben
+            writes = []
+            if h is None:
+                h = build_health(values["overviews"], values["issues"])
+                writes.append(load_health.cache.set(_route_key(load_health), h, ttl=CACHE_TTL_HEALTH))
+            if l is None:
+                l = build_licenses(values["skus"])
+                writes.append(load_licenses.cache.set(_route_key(load_licenses), l, ttl=CACHE_TTL_LICENSES))
+            if t is None:
+                org = values["organization"]
+                t = build_tenant(org[0] if org else {})
+                writes.append(load_tenant.cache.set(_route_key(load_tenant), t, ttl=CACHE_TTL_TENANT))
+            await asyncio.gather(*writes)
+            return h, l, t
+
+    # $batch fehlgeschlagen – nach Freigabe der Locks einzeln laden
+    return tuple(await asyncio.gather(load_health(), load_licenses(), load_tenant()))
+    try:
+        values = await graph.get_batch(queries)
+    except (httpx.HTTPError, RuntimeError):
+        # $batch fehlgeschlagen – einzeln laden
+        return tuple(await asyncio.gather(load_health(), load_licenses(), load_tenant()))
+
+    # Ergebnisse mit der jeweiligen TTL in die Einzel-Caches schreiben
+    writes = []
+    if h is None:
+        h = build_health(values["overviews"], values["issues"])
+        writes.append(load_health.cache.set(_route_key(load_health), h, ttl=CACHE_TTL_HEALTH))
+    if l is None:
+        l = build_licenses(values["skus"])
+        writes.append(load_licenses.cache.set(_route_key(load_licenses), l, ttl=CACHE_TTL_LICENSES))
+    if t is None:
+        org = values["organization"]
+        t = build_tenant(org[0] if org else {})
+        writes.append(load_tenant.cache.set(_route_key(load_tenant), t, ttl=CACHE_TTL_TENANT))
+    await asyncio.gather(*writes)
+    return h, l, t
+
+@cached_stampede(lease=CACHE_LEASE, ttl=CACHE_TTL_SIGNINS, key_builder=_signins_key, **cache_config(SignInSummary))
+async def load_signins(hours: int = 24) -> SignInSummary:
+    hours = _clamp_hours(hours)
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(hours=hours)
     # Graph filter requires Zulu ISO format
     since_iso = since.replace(microsecond=0).isoformat().replace("+00:00", "Z")
-    data = await graph.get_signins(since_iso)
-
-    # Bucketize per hour
-    buckets = {}
-    total = 0
-    failed = 0
-    for item in data:
-        ts = item.get("createdDateTime")
-        status = item.get("status", {})
-        error_code = int(status.get("errorCode", 0)) if status else 0
-        key = ts[:13] + ":00:00Z" if ts else "unknown"
-        if key not in buckets:
-            buckets[key] = {"total": 0, "failed": 0}
-        buckets[key]["total"] += 1
-        total += 1
-        if error_code != 0:
-            buckets[key]["failed"] += 1
-            failed += 1
-
-    # ensure all hours present
-    ordered = []
-    cur = since.replace(minute=0, second=0, microsecond=0)
-    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
-    while cur <= end:
-        key = cur.isoformat().replace("+00:00", "Z")
-        v = buckets.get(key, {"total": 0, "failed": 0})
-        ordered.append(SignInBucket(timestamp=key, total=v["total"], failed=v["failed"]))
-        cur += timedelta(hours=1)
+
+    start = since.replace(minute=0, second=0, microsecond=0)
+    end = now.replace(minute=0, second=0, microsecond=0)
+    n_hours = int((end - start).total_seconds() // 3600) + 1
+
+    # Seiten direkt beim Eintreffen in kompakte Arrays umwandeln, die Rohdaten nicht aufheben
+    hour_parts, failed_parts = [], []
+    truncated = False
+    async for page, truncated in graph.iter_signin_pages(since_iso):
+        hour_parts.append(np.array([ts[:13] if (ts := i.get("createdDateTime")) else "NaT" for i in page], dtype="datetime64[h]"))
+        failed_parts.append(np.array([int((i.get("status") or {}).get("errorCode", 0)) != 0 for i in page], dtype=bool))
+
+    # Bucketize per hour (vektorisiert: Stundenindex relativ zu start, dann bincount)
+    hour_stamps = np.concatenate(hour_parts)
+    is_failed = np.concatenate(failed_parts)
+    idx = (hour_stamps - np.datetime64(start.replace(tzinfo=None), "h")).astype(np.int64)
+    in_window = (idx >= 0) & (idx < n_hours)
+    # ein Durchlauf für beide Zählungen: Slot 2*h = erfolgreich, 2*h+1 = fehlgeschlagen
+    counts = np.bincount(idx[in_window] * 2 + is_failed[in_window], minlength=2 * n_hours).reshape(n_hours, 2)
+    total_buckets = counts.sum(axis=1).tolist()
+    failed_buckets = counts[:, 1].tolist()
+    total = len(is_failed)
+    failed = int(is_failed.sum())
+
+    # ensure all hours present – Zeitachse einmal vorberechnen, Zugriff per Stundenindex
+    times_iso = [(start + timedelta(hours=h)).strftime("%Y-%m-%dT%H:00:00Z") for h in range(n_hours)]
+    ordered = [
+        SignInBucket(timestamp=times_iso[h], total=total_buckets[h], failed=failed_buckets[h])
+        for h in range(n_hours)
+    ]
 
     failure_rate = (failed / total) * 100 if total else 0.0
 
@@ -133,9 +334,34 @@ async def signins(hours: int = 24):
         failed=failed,
         failureRate=round(failure_rate, 2),
         buckets=ordered,
+        truncated=truncated,
     )
 
+@app.get("/api/health")
+async def health():
+    return MsgspecResponse(await load_health())
+
+@app.get("/api/licenses")
+async def licenses():
+    return MsgspecResponse(await load_licenses())
+
+@app.get("/api/tenant")
+async def tenant():
+    return MsgspecResponse(await load_tenant())
+
+@app.get("/api/signins")
+async def signins(hours: int = 24):
+    return MsgspecResponse(await load_signins(hours=hours))
+
+@app.get("/api/dashboard")
+async def dashboard(hours: int = 24):
+    # alle Bereiche in einem Aufruf: fehlende Health/Lizenz/Tenant-Daten per $batch, Sign-Ins parallel dazu
+    (h, l, t), s = await asyncio.gather(load_overview(), load_signins(hours=hours))
+    return MsgspecResponse(DashboardResponse(health=h, licenses=l, tenant=t, signins=s))
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=True)
+    # uvloop gibt es nicht unter Windows (uvicorn[standard] installiert es dort nicht)
+    loop = "asyncio" if sys.platform == "win32" else "uvloop"
+    uvicorn.run("app:app", host="0.0.0.0", port=port, loop=loop, http="httptools", reload=False)
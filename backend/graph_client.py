@@ -1,30 +1,77 @@
+import asyncio
 import os, time
-from typing import Dict, Any, List
+from typing import AsyncIterator, Dict, Any, List, Tuple
+from urllib.parse import quote, urlencode
 import httpx
-from msal import ConfidentialClientApplication
+import orjson
+import redis
+from msal import ConfidentialClientApplication, SerializableTokenCache
 
 GRAPH_ROOT_V1 = "https://graph.microsoft.com/v1.0"
 
+# Issue-Status (lowercase), die als erledigt gelten
+CLOSED_STATUSES = frozenset({"servicerestored"})
+
+# (Pfad, Query) je Ressource – gemeinsam genutzt von Einzelabruf und /$batch
+HEALTH_OVERVIEWS_QUERY = ("/admin/serviceAnnouncement/healthOverviews", {"$select": "service,status"})
+HEALTH_ISSUES_QUERY = ("/admin/serviceAnnouncement/issues", {
+    "$top": 50,
+    "$select": "id,service,title,impactDescription,classification,status,startDateTime,lastModifiedDateTime",
+    # nur offene Issues – behobene gar nicht erst übertragen
+    "$filter": "status ne 'serviceRestored'",
+})
+SUBSCRIBED_SKUS_QUERY = ("/subscribedSkus", {"$select": "skuId,skuPartNumber,consumedUnits,prepaidUnits"})
+ORGANIZATION_QUERY = ("/organization", {"$select": "id,displayName,verifiedDomains"})
+
 class GraphClient:
-    def __init__(self, tenant_id: str, client_id: str, client_secret: str):
+    def __init__(self, tenant_id: str, client_id: str, client_secret: str, redis_url: str = ""):
         self.tenant_id = tenant_id
         self.client_id = client_id
         self.client_secret = client_secret
         self.authority = f"https://login.microsoftonline.com/{tenant_id}"
         self.scope = ["https://graph.microsoft.com/.default"]
+        # optional: Token-Cache in Redis teilen, damit nicht jeder Worker selbst ein Token holt
+        self._redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self._token_cache = SerializableTokenCache()
+        self._token_cache_key = f"m365monitor:msal:{tenant_id}:{client_id}"
         self._app = ConfidentialClientApplication(
             client_id=self.client_id,
             client_credential=self.client_secret,
             authority=self.authority,
+            token_cache=self._token_cache,
         )
         self._token: Dict[str, Any] | None = None
+        self._token_lock = asyncio.Lock()
+        # eine persistente Verbindung (Keep-Alive, HTTP/2) statt neuem Client pro Request
+        self._client = httpx.AsyncClient(
+            timeout=30,
+            http2=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+            headers={"Accept": "application/json"},
+        )
+
+    def _token_valid(self) -> bool:
+        return bool(self._token and "expires_at" in self._token and self._token["expires_at"] - time.time() > 60)
 
     def _get_token(self) -> str:
-        if self._token and "expires_at" in self._token and self._token["expires_at"] - time.time() > 60:
+        if self._token_valid():
             return self._token["access_token"]
-        result = self._app.acquire_token_silent(scopes=self.scope, account=None)
-        if not result:
-            result = self._app.acquire_token_for_client(scopes=self.scope)
+        result = None
+        if self._redis is not None:
+            try:
+                # Redis-Lock: pro Ablauffenster holt nur ein Worker ein neues Token, die anderen lesen den Cache
+                with self._redis.lock(f"{self._token_cache_key}:lock", timeout=30, blocking_timeout=30):
+                    state = self._redis.get(self._token_cache_key)
+                    if state:
+                        self._token_cache.deserialize(state.decode())
+                    result = self._acquire_token()
+                    if self._token_cache.has_state_changed:
+                        self._redis.set(self._token_cache_key, self._token_cache.serialize(), ex=24 * 3600)
+            except redis.RedisError:
+                # Redis nicht erreichbar oder Lock-Timeout: Token direkt bei Entra ID holen
+                pass
+        if result is None:
+            result = self._acquire_token()
         if "access_token" not in result:
             raise RuntimeError(f"Token acquisition failed: {result}")
         # msal returns expires_in seconds; compute absolute expiry
@@ -32,38 +79,102 @@ class GraphClient:
         self._token = result
         return result["access_token"]
 
+    def _acquire_token(self) -> Dict[str, Any]:
+        result = self._app.acquire_token_silent(scopes=self.scope, account=None)
+        if not result:
+            result = self._app.acquire_token_for_client(scopes=self.scope)
+        return result
+
+    async def _get_token_async(self) -> str:
+        if self._token_valid():
+            return self._token["access_token"]
+        # msal arbeitet blockierend – im Threadpool ausführen; Lock sorgt für nur einen Refresh gleichzeitig
+        async with self._token_lock:
+            if self._token_valid():
+                return self._token["access_token"]
+            return await asyncio.get_running_loop().run_in_executor(None, self._get_token)
+
     async def _get(self, url: str, params: Dict[str, Any] | None = None) -> Dict[str, Any]:
-        token = self._get_token()
+        token = await self._get_token_async()
         headers = {"Authorization": f"Bearer {token}"}
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.get(url, headers=headers, params=params)
-            r.raise_for_status()
-            return r.json()
+        r = await self._client.get(url, headers=headers, params=params)
+        r.raise_for_status()
+        return orjson.loads(r.content)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def batch(self, requests: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        # mehrere GETs in einem Round Trip über /$batch; Antworten nach id
+        token = await self._get_token_async()
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        r = await self._client.post(f"{GRAPH_ROOT_V1}/$batch", headers=headers, content=orjson.dumps({"requests": requests}))
+        r.raise_for_status()
+        return {resp["id"]: resp for resp in orjson.loads(r.content).get("responses", [])}
 
     # --- Graph wrappers ---
     async def get_health_overviews(self) -> List[Dict[str, Any]]:
-        data = await self._get(f"{GRAPH_ROOT_V1}/admin/serviceAnnouncement/healthOverviews")
+        path, params = HEALTH_OVERVIEWS_QUERY
+        data = await self._get(f"{GRAPH_ROOT_V1}{path}", params=params)
         return data.get("value", [])
 
     async def get_health_issues(self) -> List[Dict[str, Any]]:
-        data = await self._get(f"{GRAPH_ROOT_V1}/admin/serviceAnnouncement/issues", params={"$top": 50})
+        path, params = HEALTH_ISSUES_QUERY
+        url = f"{GRAPH_ROOT_V1}{path}"
+        try:
+            data = await self._get(url, params=params)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 400:
+                raise
+            # Filter nicht unterstützt: ungefiltert laden und lokal aussortieren
+            params = {k: v for k, v in params.items() if k != "$filter"}
+            data = await self._get(url, params=params)
+            return [i for i in data.get("value", []) if (i.get("status") or "").lower() not in CLOSED_STATUSES]
         return data.get("value", [])
 
     async def get_subscribed_skus(self) -> List[Dict[str, Any]]:
-        data = await self._get(f"{GRAPH_ROOT_V1}/subscribedSkus")
+        path, params = SUBSCRIBED_SKUS_QUERY
+        data = await self._get(f"{GRAPH_ROOT_V1}{path}", params=params)
         return data.get("value", [])
 
     async def get_tenant(self) -> Dict[str, Any]:
-        org = await self._get(f"{GRAPH_ROOT_V1}/organization")
+        path, params = ORGANIZATION_QUERY
+        org = await self._get(f"{GRAPH_ROOT_V1}{path}", params=params)
         items = org.get("value", [])
         return items[0] if items else {}
 
-    async def get_signins(self, since_iso: str, top: int = 200) -> List[Dict[str, Any]]:
-        # v1.0 is available; pagination omitted for simplicity (top capped)
+    async def get_batch(self, queries: Dict[str, Tuple[str, Dict[str, Any]]]) -> Dict[str, List[Dict[str, Any]]]:
+        # mehrere Listenabfragen (id -> (Pfad, Query)) in einem einzigen /$batch-Request
+        responses = await self.batch([
+            {"id": key, "method": "GET", "url": f"{path}?{urlencode(params, quote_via=quote, safe='$,')}"}
+            for key, (path, params) in queries.items()
+        ])
+        values = {}
+        for key in queries:
+            resp = responses.get(key)
+            if not resp or resp.get("status", 500) >= 400:
+                raise RuntimeError(f"Batch request '{key}' failed: {resp}")
+            values[key] = resp.get("body", {}).get("value", [])
+        return values
+
+    async def iter_signin_pages(self, since_iso: str, top: int = 1000, max_pages: int = 10) -> AsyncIterator[Tuple[List[Dict[str, Any]], bool]]:
+        # Liefert (Einträge, weitere Seiten vorhanden). Neueste zuerst, damit das Seitenlimit
+        # die ältesten Sign-Ins abschneidet; ist das Flag der letzten Seite gesetzt, wurde gekürzt.
+        # Graph liefert @odata.nextLink mit opakem $skiptoken – Seiten daher nacheinander abrufen.
+        # Liefert immer mindestens eine Seite.
         params = {
             "$filter": f"createdDateTime ge {since_iso}",
-            "$orderby": "createdDateTime asc",
+            "$orderby": "createdDateTime desc",
             "$top": str(top),
+            # nur die Felder fürs Bucketing – spart die großen location/deviceDetail-Objekte
+            "$select": "createdDateTime,status",
         }
         data = await self._get(f"{GRAPH_ROOT_V1}/auditLogs/signIns", params=params)
-        return data.get("value", [])
+        pages = 1
+        while True:
+            next_link = data.get("@odata.nextLink")
+            yield data.get("value", []), bool(next_link)
+            if not next_link or pages >= max_pages:
+                return
+            data = await self._get(next_link)
+            pages += 1
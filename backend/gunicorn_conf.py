@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+# Start: gunicorn -c gunicorn_conf.py app:app
+# Ohne REDIS_URL hätte jeder Worker eigenes Token und eigene Caches und würde Graph
+# entsprechend oft abfragen – dann nur ein Worker. Mit REDIS_URL: alle Kerne nutzen.
+load_dotenv()
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+_default_workers = multiprocessing.cpu_count() * 2 + 1 if os.getenv("REDIS_URL") else 1
+workers = int(os.getenv("WEB_CONCURRENCY", _default_workers))
+worker_class = "uvicorn_worker.UvicornWorker"
+keepalive = 30
@@ -1,7 +1,7 @@
-from pydantic import BaseModel
+import msgspec
 from typing import List, Optional
 
-class HealthIssue(BaseModel):
+class HealthIssue(msgspec.Struct):
     id: str
     service: Optional[str] = None
     title: Optional[str] = None
@@ -11,40 +11,47 @@ class HealthIssue(BaseModel):
     startDateTime: Optional[str] = None
     lastModifiedDateTime: Optional[str] = None
 
-class HealthOverview(BaseModel):
+class HealthOverview(msgspec.Struct):
     service: str
     status: str
 
-class HealthResponse(BaseModel):
+class HealthResponse(msgspec.Struct):
     services: List[HealthOverview]
     openIssues: List[HealthIssue]
 
-class LicenseSku(BaseModel):
+class LicenseSku(msgspec.Struct):
     skuId: str
     skuPartNumber: str
     consumedUnits: int
     enabled: int
     warning: Optional[str] = None
 
-class LicenseResponse(BaseModel):
+class LicenseResponse(msgspec.Struct):
     skus: List[LicenseSku]
 
-class SignInBucket(BaseModel):
+class SignInBucket(msgspec.Struct):
     timestamp: str
     total: int
     failed: int
 
-class SignInSummary(BaseModel):
+class SignInSummary(msgspec.Struct):
     windowHours: int
     total: int
     failed: int
     failureRate: float
     buckets: List[SignInBucket]
+    truncated: bool = False  # Seitenlimit erreicht, älteste Sign-Ins fehlen
 
-class TenantInfo(BaseModel):
+class TenantInfo(msgspec.Struct):
     id: str
     displayName: Optional[str] = None
     verifiedDomains: List[str] = []
 
-class TenantResponse(BaseModel):
+class TenantResponse(msgspec.Struct):
     tenant: TenantInfo
+
+class DashboardResponse(msgspec.Struct):
+    health: HealthResponse
+    licenses: LicenseResponse
+    tenant: TenantResponse
+    signins: SignInSummary
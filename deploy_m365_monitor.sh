@@ -172,7 +172,8 @@ Type=simple
 User=${RUN_USER}
 WorkingDirectory=${APP_DIR}/backend
 EnvironmentFile=${ENV_FILE}
-ExecStart=${APP_DIR}/.venv/bin/python -m uvicorn app:app --host 127.0.0.1 --port \${PORT}
+# Worker: 1 ohne REDIS_URL, sonst 2 x CPU + 1; WEB_CONCURRENCY in ${ENV_FILE} ueberschreibt
+ExecStart=${APP_DIR}/.venv/bin/gunicorn -c gunicorn_conf.py --bind 127.0.0.1:\${PORT} app:app
 Restart=on-failure
 RestartSec=3
 
@@ -65,7 +65,7 @@ let chart;
 async function loadSignins(hours=24){
   try {
     const s = await json(`signins?hours=${hours}`);
-    document.getElementById('siTotal').textContent = s.total;
+    document.getElementById('siTotal').textContent = s.truncated ? `${s.total}+` : s.total; // gekürzt: älteste Sign-Ins fehlen
     document.getElementById('siFailed').textContent = s.failed;
     document.getElementById('siRate').textContent = `${s.failureRate}%`;
 